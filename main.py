@@ -1,4 +1,4 @@
-from typing import Dict, List, Optional
+from typing import Dict, List, Literal, Optional, Union
 from pymongo.mongo_client import MongoClient
 from fastapi import Depends, FastAPI, HTTPException, Request, Response, status, Form, Body, File
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
@@ -9,10 +9,22 @@ from pydantic import BaseModel, Field, EmailStr
 from rich.console import Console
 import motor.motor_asyncio
 from bson.objectid import ObjectId
+from bson.errors import InvalidId
 from fastapi.middleware.cors import CORSMiddleware
 from passlib.handlers.sha2_crypt import sha512_crypt as crypto
 import hashlib
-from prompts import (get_token, get_chat_completion)
+import secrets
+from prompts import (
+    complete_chat,
+    stream_chat_completion,
+    TokenManager,
+    GigaChatError,
+    TokenRejected,
+    CircuitOpen,
+    gigachat,
+    gigachat_breaker,
+    TURN_DEADLINE,
+)
 import json
 from datetime import datetime
 import time
@@ -20,6 +32,9 @@ from pdf.p import create_rep
 from reportlab.platypus import SimpleDocTemplate
 from reportlab.lib.pagesizes import letter
 import io, os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from fastapi.responses import StreamingResponse, FileResponse, Response
 
 from sub_app.server.database import (
@@ -33,9 +48,44 @@ from sub_app.server.database import (
     add_clinic,
     add_doc_to_userbase,
     reject_appointment,
+    bulk_update_appointments,
+    retrieve_free_slots,
+    earliest_free_slots,
+    search_doctors,
     taken_check,
+    retrieve_user_credentials,
+    retrieve_doctor_credentials,
+    update_user_password,
+    update_doctor_password,
+    database as async_db,
+    slot_helper,
+    REQUESTED,
+    CONFIRMED,
+    REJECTED,
+    SLOT_TAKEN,
+    QUOTA_EXCEEDED,
+    OFF_GRID,
 
 )
+from sub_app.server.cache import principal_cache
+from sub_app.server.events import event_hub
+from sub_app.server.availability import free_slots_cache
+from sub_app.server.admission import llm_gate, Rejected
+from sub_app.server.queries import (
+    user_auth_projection,
+    user_card_projection,
+    user_profile_projection,
+    doctor_auth_projection,
+    doctor_profile_projection,
+    doctor_for_user_projection,
+    doctor_slots,
+    user_calendar,
+    doctor_calendar,
+    NEWEST_VERSION,
+    calendar_changes,
+    active_req_id,
+)
+from sub_app.server.indexes import apply_indexes
 from sub_app.server.models import (
     ErrorResponseModel,
     ResponseModel,
@@ -70,52 +120,11 @@ except Exception as e:
 db = client["users"]  # an organisation name not "users"
 user_collection = db["users_collection"]
 doctor_collection = db["doctors_collection"]
-appointment_collection = db["appointments_collection"]
+slot_collection = db["slots_collection"]
 clinic_collection = db["clinics_collection"]
 prom_history = db["prom_history"]
 
 # helpers
-def user_helper(user) -> dict:
-    return {
-        "id": str(user["_id"]),
-        "name": user["name"],
-        "login": user["login"],
-        "birth": user["birth"],
-        "address": user["address"],
-        "main_doctor_id": user["main_doctor_id"],
-        "history": user["history"],
-        "password": user["password"],
-        "doctors_ids": user["doctors_ids"],
-        "convos": user["convos"],
-        "phone": user["phone"],
-    }
-def user_helper_extra(user) -> dict:
-    return {
-        #"id": str(user["_id"]),
-        "name": user["name"],
-       #"login": user["login"],
-        "birth": user["birth"],
-       # "address": user["address"],
-        "main_doctor_id": user["main_doctor_id"],
-        "history": user["history"],
-        #"password": user["password"],
-        "doctors_ids": user["doctors_ids"],
-        #"convos": user["convos"],
-        "phone": user["phone"],
-    }
-
-def doctor_helper(user) -> dict:
-    return {
-        "id": str(user["_id"]),
-        "specialty": user["specialty"],
-        "name": user["name"],
-        "surname": user["surname"],
-        "father_name": user["father_name"],
-        "email": user["email"],
-        "login": user["login"],
-        "password": user["password"],
-    }
-
 def doctor_helper_for_user(user) -> dict:
     return {
         "id": str(user["_id"]),
@@ -143,170 +152,100 @@ def prom_helper(user):
     return user["conv_history"]
 
 
-def app_helper(user):
-    return user["requests"]
-
-
-def app_helper_conf(user):
-    # return user["confirms"]
-    return user["confirms"], user["doctor_id"]
-
-
 def doc_helper_user(user):
     return user["doctors_ids"]
 
 
-def conf_helper(user) -> dict:
-    return user["confirms"]
-
-
-def app_helper1(user) -> dict:
-    return user["requests"], user["doctor_id"]
-
-
 def conv_helper(user):
     return user["convos"]
 
 
-# Retrieve all users present in the database
-def get_users():
-    users = []
-    for user in user_collection.find():
-        users.append(user_helper(user))
-    return users
+def to_object_id(id):
+    try:
+        return ObjectId(id)
+    except (InvalidId, TypeError):
+        return None
 
-def get_users_appointment_data():
-    users = []
-    for user in user_collection.find():
-        users.append(user_helper_extra(user))
-    return users
 
-def get_docs():
-    users = []
-    for user in doctor_collection.find():
-        users.append(doctor_helper(user))
-    return users
+def principal_helper(user) -> dict:
+    res = {"id": str(user["_id"])}
+    res.update({k: v for k, v in user.items() if k != "_id"})
+    return res
 
 
-def get_appointments(user_id):
-    apps = []
-    ask = appointment_collection.find({"requests": {"$elemMatch": {"user_id": user_id}}})
-    ask1 = appointment_collection.find({"confirms": {"$elemMatch": {"user_id": user_id}}})
-    for app in ask:
-        apps.append(app_helper1(app))
-    for app1 in ask1:
-        apps.append(conf_helper(app1))
-
-    count = 0
-    for app_card in apps:
-        for app in app_card:
-            count = count + 1
-    if count > 3:
-        return False
-    return apps
-
-
-def get_docs_for_user():
-    users = []
-    for user in doctor_collection.find():
-        users.append(doctor_helper_for_user(user))
-    return users
+def find_user(query: dict, projection=None):
+    user = user_collection.find_one(query, projection or user_profile_projection)
+    if user:
+        return principal_helper(user)
+    return None
+
+
+def find_doctor(query: dict, projection=None):
+    doctor = doctor_collection.find_one(query, projection or doctor_profile_projection)
+    if doctor:
+        return principal_helper(doctor)
+    return None
 
 
 # -> User deleted
 def get_user_id(username: str):
-    DB = get_users()
-    users = []
-    for user in DB:
-        if user.get("login") == username:
-            users.append(user)
-    if users:
-        res_user = users[0]
-
-        return res_user.get('id')
+    user = find_user({"login": username}, user_auth_projection)
+    if user:
+        return user.get('id')
     return None
 
 
 def get_doctor_id(username: str):
-    DB = get_docs()
-    users = []
-    for user in DB:
-        if user.get("login") == username:
-            users.append(user)
-    if users:
-        res_user = users[0]
-
-        return res_user.get('id')
+    doctor = find_doctor({"login": username}, doctor_auth_projection)
+    if doctor:
+        return doctor.get('id')
     return None
 
 
 def get_doctor_id_email(username: str):
-    DB = get_docs()
-    users = []
-    for user in DB:
-        if user.get("email") == username:
-            users.append(user)
-    if users:
-        res_user = users[0]
-
-        return res_user.get('id')
+    doctor = find_doctor({"email": username}, doctor_auth_projection)
+    if doctor:
+        return doctor.get('id')
     return None
 
 
-def get_user_with_id(id):
-    DB = get_users()
-    users = []
-    for user in DB:
-        if user.get("id") == id:
-            users.append(user)
-    if users:
-        res_user = users[0]
-        print(res_user)
-        return res_user
-    
-    return None
+def get_user_with_id(id, projection=None):
+    oid = to_object_id(id)
+    if oid is None:
+        return None
+    return find_user({"_id": oid}, projection)
 
-def get_user_with_id_appointment(id):
-    DB = get_users_appointment_data()
-    users = []
-    for user in DB:
-        if user.get("id") == id:
-            users.append(user)
-    if users:
-        res_user = users[0]
-        return res_user
-    
-    return None
 
+def get_doc_with_id(id, projection=None):
+    oid = to_object_id(id)
+    if oid is None:
+        return None
+    return find_doctor({"_id": oid}, projection)
 
-def get_doc_with_id(id):
-    DB = get_docs()
 
-    users = []
-    for user in DB:
-        if user.get("id") == id:
-            users.append(user)
-    if users:
-        res_user = users[0]
+def get_doc_with_id_for_user(id):
+    return get_doc_with_id(id, doctor_for_user_projection)
 
-        return res_user
-    return None
 
+# Resolves many users with one $in query, returns {id: user}
+def get_users_with_ids(ids, projection=None):
+    oids = [oid for oid in {to_object_id(id) for id in ids} if oid is not None]
+    users = {}
+    if oids:
+        for user in user_collection.find({"_id": {"$in": oids}}, projection or user_card_projection):
+            users[str(user["_id"])] = principal_helper(user)
+    return users
 
-def get_doc_with_id_for_user(id):
-    DB = get_docs_for_user()
-    users = []
-    for user in DB:
-        if user.get("id") == id:
-            users.append(user)
-    if users:
-        res_user = users[0]
-
-        return res_user
-    return None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await apply_indexes(async_db)
+    yield
+    verify_pool.shutdown(wait=False)
+    await gigachat.aclose()
 
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 # templates = Jinja2Templates(directory="templates")
 
 origins = [
@@ -353,11 +292,26 @@ def signJWT(user_id: str) -> Dict[str, str]:
     return token_response(token)
 
 
+def get_principal(kind: str, id):
+    # Slim profile of a verified principal, served from principal_cache when possible
+    principal = principal_cache.get(kind, id)
+    if principal is None:
+        if kind == "doctor":
+            principal = get_doc_with_id(id, doctor_auth_projection)
+        else:
+            principal = get_user_with_id(id, user_auth_projection)
+        if principal:
+            principal_cache.put(kind, id, principal)
+    return principal
+
+
 def decodeJWT(token: str) -> dict:
     try:
         decoded_token = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        if get_user_with_id(decoded_token.get('user_id')):
-            return decoded_token if decoded_token["expires"] >= time.time() else None
+        if decoded_token["expires"] < time.time():
+            return None
+        if get_principal("user", decoded_token.get('user_id')):
+            return decoded_token
         else:
             None
     except:
@@ -367,35 +321,56 @@ def decodeJWT(token: str) -> dict:
 def decodeJWT_doc(token: str) -> dict:
     try:
         decoded_token = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        if get_doc_with_id((decoded_token).get('user_id')):
-
-            return decoded_token if decoded_token["expires"] >= time.time() else None
+        if decoded_token["expires"] < time.time():
+            return None
+        if get_principal("doctor", (decoded_token).get('user_id')):
+            return decoded_token
         else:
             None
     except:
         return {}
 
 
-def check_user(data: UserLoginSchema):
-    DB = get_users()
-    for user in DB:
-        if user.get('login') == data.login and crypto.verify(data.password, user.get("password")):
-            return True
-    return False
+# Password hashing policy: sha512_crypt rounds for new hashes and whether
+# hashes with other rounds are upgraded on successful login
+password_rounds = config("password_rounds", default=0, cast=int)
+rehash_on_login = config("rehash_on_login", default=False, cast=bool)
+pwd_context = crypto.using(rounds=password_rounds) if password_rounds else crypto
 
+# Hashing is CPU bound, keep it off the event loop
+verify_pool = ThreadPoolExecutor(max_workers=config("verify_workers", default=4, cast=int),
+                                 thread_name_prefix="pwd")
 
-def check_dock(data: DoctorLoginSchema):
-    DB = get_docs()
-    for user in DB:
-        if user.get('login') == data.login and crypto.verify(data.password, user.get("password")):
-            return True
-    return False
+
+async def run_hasher(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(verify_pool, func, *args)
+
+
+async def verify_credentials(cred, password: str, set_password):
+    if cred is None:
+        return None
+    if not await run_hasher(pwd_context.verify, password, cred.get("password")):
+        return None
+    if rehash_on_login and pwd_context.needs_update(cred.get("password")):
+        await set_password(cred.get("id"), await run_hasher(pwd_context.hash, password))
+    return cred.get("id")
+
+
+async def check_user(data: UserLoginSchema):
+    cred = await retrieve_user_credentials(data.login)
+    return await verify_credentials(cred, data.password, update_user_password)
+
+
+async def check_dock(data: DoctorLoginSchema):
+    cred = await retrieve_doctor_credentials(data.login)
+    return await verify_credentials(cred, data.password, update_doctor_password)
 
 
 @app.post("/user/login", tags=["user"])
 async def user_login(user: UserLoginSchema):
-    if check_user(user):
-        id = get_user_id(user.login)
+    id = await check_user(user)
+    if id:
         return signJWT(id)
     return False
 
@@ -471,6 +446,24 @@ async def tok1(tok: token1):
     return False
 
 
+# /metrics shows cache, queue and breaker internals, so it is only served to
+# callers presenting metrics_token as a bearer token, and not at all without one
+metrics_token = config("metrics_token", default="")
+
+
+def metrics_access(credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer(auto_error=False))):
+    if not metrics_token or not credentials or not secrets.compare_digest(credentials.credentials, metrics_token):
+        raise HTTPException(status_code=403, detail="Invalid authorization code.")
+
+
+@app.get("/metrics", tags=["metrics"], dependencies=[Depends(metrics_access)])
+def metrics():
+    return {"principal_cache": principal_cache.stats(), "event_hub": event_hub.stats(),
+            "free_slots_cache": free_slots_cache.stats(), "giga_token": giga_tokens.stats(),
+            "gigachat": gigachat.stats(), "llm_gate": llm_gate.stats(),
+            "gigachat_breaker": gigachat_breaker.stats()}
+
+
 @app.post("/get_user", tags=["user"])
 def get_user_data(token: token1) -> dict:
     a = JWTBearer()
@@ -540,31 +533,24 @@ async def get_doc_by_id(token: token1):
 #################registration##########################
 
 
-def check_login(username: str):
-    DB = get_users()
-    for user in DB:
-        if user.get("login") == username:
-            return False
-
-    return True
-
-
 @app.post("/register", tags=["user"])
 async def register_user(user: UserSchema):
-    if check_login(user.login):
-        schema_extra = {
-            "name": user.name,
-            "birth": user.birth,
-            "phone": user.phone,
-            "doctors_ids": [],
-            "address": '',
-            "main_doctor_id": '',
-            "history": [{'name': '', 'time': ''}],
-            "login": user.login,
-            "password": crypto.hash(user.password),
-            "convos": [],
-        }
-        new_user = await add_user(schema_extra)
+    schema_extra = {
+        "name": user.name,
+        "birth": user.birth,
+        "phone": user.phone,
+        "doctors_ids": [],
+        "address": '',
+        "main_doctor_id": '',
+        "history": [{'name': '', 'time': ''}],
+        "login": user.login,
+        "password": await run_hasher(pwd_context.hash, user.password),
+        "convos": [],
+        "active_appointments": 0,
+    }
+    # users_collection.login is unique, add_user returns None for a taken login
+    new_user = await add_user(schema_extra)
+    if new_user:
         return {"message": "User registered successfully"}
     else:
         return {"message": "Login already registrated"}
@@ -582,19 +568,21 @@ async def register_doc(doctor: DoctorSchema):
         "working_days": doctor.working_days,
         "email": doctor.email,
         "login": doctor.login,
-        "password": crypto.hash(doctor.password),
+        "password": await run_hasher(pwd_context.hash, doctor.password),
         "clinic_name": doctor.clinic_name,
     }
     new_doctor = await add_doctor(schema_extra)
     # app_schema = {}
+    if not new_doctor:
+        return {"message": "Login already registrated"}
 
     return {"message": "Doctor added successfully"}
 
 
 @app.post("/doctor/login", tags=["doctor"])
 async def doc_login(user: DoctorLoginSchema):
-    if check_dock(user):
-        id = get_doctor_id(user.login)
+    id = await check_dock(user)
+    if id:
         return signJWT(id)
 
     return ErrorResponseModel(
@@ -618,28 +606,89 @@ async def check_appointment_data(day: appoint_check):
     return time_stamps
 
 
+class free_slots_query(BaseModel):
+    doctor_email: str
+    # first day, "YYYY-MM-DD", today by default
+    start: Optional[str] = None
+    days: int = 7
+
+
+MAX_AVAILABILITY_DAYS = 31
+
+
+@app.post("/free_slots", tags=["user"])
+async def free_slots(q: free_slots_query):
+    doctor_id = get_doctor_id_email(q.doctor_email)
+    if doctor_id is None:
+        return ErrorResponseModel("An error occurred", 404, "There was no such doctor.")
+    try:
+        first_day = datetime.strptime(q.start, "%Y-%m-%d").date() if q.start else datetime.today().date()
+    except ValueError:
+        return ErrorResponseModel("An error occurred", 400, "start must be YYYY-MM-DD")
+    days = min(max(q.days, 1), MAX_AVAILABILITY_DAYS)
+    return await retrieve_free_slots(doctor_id, first_day, days)
+
+
+class earliest_slots_query(BaseModel):
+    specialty: Optional[str] = None
+    clinic_name: Optional[str] = None
+    # first day, "YYYY-MM-DD", today by default
+    start: Optional[str] = None
+    days: int = 14
+    limit: int = 10
+
+
+MAX_SEARCH_RESULTS = 50
+
+
+# Soonest free slots with any doctor of a specialty and/or clinic
+@app.post("/earliest_slots", tags=["user"])
+async def earliest_slots(q: earliest_slots_query):
+    query = {}
+    if q.specialty:
+        query["specialty"] = q.specialty
+    if q.clinic_name:
+        query["clinic_name"] = q.clinic_name
+    if not query:
+        return ErrorResponseModel("An error occurred", 400, "specialty or clinic_name is required")
+    try:
+        first_day = datetime.strptime(q.start, "%Y-%m-%d").date() if q.start else datetime.today().date()
+    except ValueError:
+        return ErrorResponseModel("An error occurred", 400, "start must be YYYY-MM-DD")
+    days = min(max(q.days, 1), MAX_AVAILABILITY_DAYS)
+    limit = min(max(q.limit, 1), MAX_SEARCH_RESULTS)
+    doctors = await search_doctors(query)
+    found = await earliest_free_slots(doctors, first_day, days, limit)
+    for slot in found:
+        slot["doctor"] = {k: v for k, v in doctors[slot["doctor_id"]].items() if k != "working_days"}
+    return found
+
+
 @app.put("/add_appointment_data", tags=["user"])
 async def add_appointment_data(upd: UpdateAppointModel_User):
     try:
         user_id = str(decodeJWT(upd.token).get("user_id"))
     except:
         return ErrorResponseModel("No such user found", 404, "login again")
-    a = get_appointments(user_id)
-    if a != False:
-        today = datetime.today().strftime('%Y-%m-%d')
-        app_date = f"20{upd.year}-{upd.month}-{upd.day}"
-        tod = time.strptime(today, "%Y-%m-%d")
-        to_app = time.strptime(app_date, "%Y-%m-%d")
-        if to_app < tod:
-            return ErrorResponseModel("An error occurred", 405, "You can't appoint before today")
-        req = {"date": app_date, "time": f"{int(upd.hour):02d}:{int(upd.minutes):02d}"}
-        update_schema = {"doctor_id": get_doctor_id_email(upd.doctor_email), "user_id": str(user_id), "request": req}
-        updated_app = await update_app(update_schema)
-        if updated_app:
-            return {"message": "User appointed successfully"}
-        return ErrorResponseModel("An error occurred", 111, "There was an error updating the appointment data.")
-    else:
+    today = datetime.today().strftime('%Y-%m-%d')
+    app_date = f"20{upd.year}-{upd.month}-{upd.day}"
+    tod = time.strptime(today, "%Y-%m-%d")
+    to_app = time.strptime(app_date, "%Y-%m-%d")
+    if to_app < tod:
+        return ErrorResponseModel("An error occurred", 405, "You can't appoint before today")
+    req = {"date": app_date, "time": f"{int(upd.hour):02d}:{int(upd.minutes):02d}"}
+    update_schema = {"doctor_id": get_doctor_id_email(upd.doctor_email), "user_id": str(user_id), "request": req}
+    # The 4-appointment quota is enforced by update_app together with the booking
+    updated_app = await update_app(update_schema)
+    if updated_app == OFF_GRID:
+        return ErrorResponseModel("An error occurred", 400, "Appointments start on the hour or half past")
+    if updated_app == QUOTA_EXCEEDED:
         return ErrorResponseModel("You can't appoint more than 4 times", 444, "error")
+    if updated_app == SLOT_TAKEN:
+        return ErrorResponseModel("Slot already taken", 409, "This time is already booked, choose another one")
+    if updated_app:
+        return {"message": "User appointed successfully"}
+    return ErrorResponseModel("An error occurred", 111, "There was an error updating the appointment data.")
 
 
 class r_id(BaseModel):
@@ -677,6 +726,30 @@ async def conf1(conf_data: r_id):
     )
 
 
+MAX_BULK_ACTIONS = 200
+
+
+class r_id_action(BaseModel):
+    idd: str
+    action: Literal["confirm", "reject"]
+
+
+class bulk_r_id(BaseModel):
+    token: str
+    actions: List[r_id_action]
+
+
+@app.post("/bulk_conf", tags=['doctor'])
+async def bulk_conf(conf_data: bulk_r_id):
+    decoded = decodeJWT_doc(conf_data.token)
+    if not decoded:
+        return ErrorResponseModel("No such doctor found", 404, "login again")
+    if len(conf_data.actions) > MAX_BULK_ACTIONS:
+        return ErrorResponseModel("Too many actions", 413, f"Send at most {MAX_BULK_ACTIONS} actions at once")
+    doctor_id = str(decoded.get("user_id"))
+    return await bulk_update_appointments(doctor_id, [(a.idd, a.action) for a in conf_data.actions])
+
+
 ##############################################################################
 # optional
 '''
@@ -777,35 +850,62 @@ async def delete_user_data(id: str):
 
 
 ##############################################################################
-def get_confirms(doctor_id):
-    elems = []
-    appointment_card = appointment_collection.find({"doctor_id": doctor_id})
-    for elem in appointment_card:
-        elems.append(conf_helper(elem))
-    return elems
+class calendar_window(BaseModel):
+    token: str
+    # Optional visible range of the calendar, ISO dates or datetimes as sent by FullCalendar
+    start: Optional[str] = None
+    end: Optional[str] = None
+
+
+# (start, end) of the window, None when a bound cannot be parsed
+def parse_window(window: calendar_window):
+    bounds = []
+    for value in (window.start, window.end):
+        try:
+            # Slots store the clinic's wall-clock time, so an offset is dropped, not converted
+            bounds.append(datetime.fromisoformat(value).replace(tzinfo=None) if value else None)
+        except ValueError:
+            return None
+    return bounds
 
 
-def get_requests(doctor_id):
+def invalid_window(window: calendar_window):
+    return ErrorResponseModel("An error occurred", 400, f"Invalid calendar range: {window.start} - {window.end}")
+
+
+# Appointments of a doctor with the given status, optionally limited to
+# [start, end), served by the (doctor_id, status, start) index
+# Calendar views list appointments by start. sort="version" lists them in the
+# order they were last changed, i.e. booked or confirmed.
+def get_slots(doctor_id, status, start=None, end=None, sort="start"):
     elems = []
-    appointment_card = appointment_collection.find({"doctor_id": doctor_id})
-    for elem in appointment_card:
-        elems.append(app_helper(elem))
+    for elem in slot_collection.find(doctor_slots(doctor_id, status, start, end), {"_id": 0}).sort(sort, 1):
+        elems.append(slot_helper(elem))
     return elems
 
 
+def get_confirms(doctor_id, start=None, end=None):
+    return get_slots(doctor_id, CONFIRMED, start, end)
+
+
+def get_requests(doctor_id, start=None, end=None):
+    return get_slots(doctor_id, REQUESTED, start, end)
+
+
 @app.post("/events_docs", tags=["doctor"])
-def get_events(token: token1):
+def get_events(token: calendar_window):
+    bounds = parse_window(token)
+    if bounds is None:
+        return invalid_window(token)
+    start, end = bounds
     doctor_id = str(decodeJWT_doc(token.token).get("user_id"))
-    reqs = get_confirms(doctor_id)
-    try:
-        requests = reqs[0]
-    except:
-        pass
+    requests = get_confirms(doctor_id, start, end)
+    users = get_users_with_ids([req.get("user_id") for req in requests])
     returned = []
     for req in requests:
         date = req.get("date")
         time = req.get("time")
-        user = get_user_with_id(req.get("user_id")).get("name")
+        user = users.get(req.get("user_id"), {}).get("name")
         new = {"title": user, "start": f'{date}T{time}:00', "end": f'{date}T{time[0]}{time[1]}:30:00', "allDay": False}
         returned.append(new)
 
@@ -813,83 +913,163 @@ def get_events(token: token1):
 
 
 @app.post("/suggested_events", tags=["doctor"])
-def get_suggested_events(token: token1):
+def get_suggested_events(token: calendar_window):
+    bounds = parse_window(token)
+    if bounds is None:
+        return invalid_window(token)
+    start, end = bounds
     doctor_id = str(decodeJWT_doc(token.token).get("user_id"))
-    reqs = get_requests(doctor_id)
-    requests = reqs[0]
+    requests = get_requests(doctor_id, start, end)
+    users = get_users_with_ids([req.get("user_id") for req in requests])
     returned = []
     for req in requests:
         date = req.get("date")
         time = req.get("time")
-        username = get_user_with_id(req.get("user_id")).get("name")
-        phone = get_user_with_id(req.get("user_id")).get("phone")
+        u = users.get(req.get("user_id"), {})
+        username = u.get("name")
+        phone = u.get("phone")
         new = {"username": username, "phone": phone, "id": req.get('req_id'), "title": "Appointment", "start": f'{date}T{time}:00',
                "end": f'{date}T{time[0]}{time[1]}:30:00', "allDay": False}
         returned.append(new)
     return returned
 
 
+class calendar_delta(BaseModel):
+    token: str
+    # calendar version the client last synced, 0 for a full load
+    since: int = 0
+
+
+# Versions are the writers' clocks in microseconds, read just before the write,
+# so a change can become visible slightly after a later one. Deltas re-send the
+# last SYNC_OVERLAP microseconds of changes to cover that and small clock skew
+# between app servers; clients apply events by id, so repeats are harmless. A
+# change still in flight for longer is not re-sent, so clients must also do a
+# full reload (since=0) periodically, e.g. every few minutes and on focus.
+SYNC_OVERLAP = 5_000_000
+
+
+@app.post("/events_delta", tags=["doctor"])
+def get_events_delta(delta: calendar_delta):
+    doctor_id = str(decodeJWT_doc(delta.token).get("user_id"))
+    latest = slot_collection.find_one(doctor_calendar(doctor_id), {"_id": 0, "version": 1},
+                                      sort=NEWEST_VERSION) or {}
+    version = latest.get("version", 0)
+    returned = {"version": version, "added": [], "confirmed": [], "removed": []}
+    if delta.since and delta.since >= version:
+        return returned
+
+    after = max(delta.since - SYNC_OVERLAP, 0) if delta.since else None
+    slots = [slot_helper(slot) for slot in slot_collection.find(calendar_changes(doctor_id, after), {"_id": 0})]
+    users = get_users_with_ids([slot.get("user_id") for slot in slots if slot.get("status") != REJECTED])
+    for req in slots:
+        if req.get("status") == REJECTED:
+            returned["removed"].append(req.get("req_id"))
+            continue
+        date = req.get("date")
+        time = req.get("time")
+        u = users.get(req.get("user_id"), {})
+        if req.get("status") == REQUESTED:
+            returned["added"].append({"username": u.get("name"), "phone": u.get("phone"), "id": req.get('req_id'),
+                                      "title": "Appointment", "start": f'{date}T{time}:00',
+                                      "end": f'{date}T{time[0]}{time[1]}:30:00', "allDay": False})
+        else:
+            returned["confirmed"].append({"id": req.get('req_id'), "title": u.get("name"),
+                                          "start": f'{date}T{time}:00',
+                                          "end": f'{date}T{time[0]}{time[1]}:30:00', "allDay": False})
+    return returned
+
+
+SSE_KEEPALIVE = 15
+
+
+class ClosingStreamingResponse(StreamingResponse):
+    """StreamingResponse that calls on_close once the response is over.
+
+    Starlette skips the body when the client is already gone, and a body
+    generator that never started never runs its finally, so resources taken
+    for the stream are released here instead.
+    """
+
+    def __init__(self, content, on_close, **kwargs):
+        super().__init__(content, **kwargs)
+        self.on_close = on_close
+        self.closed = False
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.on_close()
+
+
+async def doctor_event_stream(request: Request, sub):
+    yield "retry: 5000\n\n"
+    while not await request.is_disconnected():
+        try:
+            event = await asyncio.wait_for(sub.queue.get(), timeout=SSE_KEEPALIVE)
+        except asyncio.TimeoutError:
+            yield ": keepalive\n\n"
+            continue
+        if event is None:
+            # dropped by the hub for falling behind, the client reconnects and syncs via /events_delta
+            break
+        yield f"event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+
+# EventSource cannot send headers or a body, so the token comes in the query string
+@app.get("/events_stream", tags=["doctor"])
+async def events_stream(request: Request, token: str):
+    decoded = decodeJWT_doc(token)
+    if not decoded:
+        raise HTTPException(status_code=403, detail="Invalid token or expired token.")
+    sub = event_hub.subscribe(str(decoded.get("user_id")))
+    if sub is None:
+        raise HTTPException(status_code=429, detail="Too many open event streams.")
+    return ClosingStreamingResponse(doctor_event_stream(request, sub), on_close=lambda: event_hub.unsubscribe(sub),
+                                    media_type="text/event-stream",
+                                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 @app.post("/recent_patients", tags=["doctor"])
 async def get_events(token: token1):
     doctor_id = str(decodeJWT_doc(token.token).get("user_id"))
-    reqs = get_confirms(doctor_id)
-
-    try:
-        requests = reqs[0]
-    except:
-        pass
+    # patients in the order their appointments were confirmed
+    requests = get_slots(doctor_id, CONFIRMED, sort="version")
+    users = get_users_with_ids([req.get("user_id") for req in requests])
     returned = []
+    seen = set()
     for req in requests:
         id = req.get("user_id")
-        u = get_user_with_id(id)
+        if id in seen:
+            continue
+        seen.add(id)
+        u = users.get(id, {})
         user = u.get("name")
         user_birth = u.get('birth')
         new = {'username': user, 'birth': user_birth, 'user_id': req.get("user_id")}
-        if new not in returned:
-            returned.append(new)
-        console.log(returned)
+        returned.append(new)
 
     return returned
 
-def get_confirms_user(user_id):
-    pipeline = [
-        {"$unwind": "$confirms"},
-        {"$match": {"confirms.user_id": user_id}},
-        {
-            "$project": {
-                "_id": 0,
-                "doctor_id": 1,
-                "req_id": "$confirms.con_id",
-                "date": "$confirms.date",
-                "time": "$confirms.time",
-                "user_id": "$confirms.user_id"
-            }
-        }
-    ]
-    result = appointment_collection.aggregate(pipeline)
-    elems = list(result)
-    return elems
+# A user's appointments with the given status joined with their doctors in one
+# aggregation. The (user_id, status, start) index serves both the match and the
+# sort, so the cost follows the user's own bookings, not the whole collection.
+def get_slots_user(user_id, status, start=None, end=None):
+    return slot_collection.aggregate(user_calendar(user_id, status, start, end))
 
-def get_requests_user(user_id):
-    pipeline = [
-        {"$unwind": "$requests"},
-        {"$match": {"requests.user_id": user_id}},
-        {
-            "$project": {
-                "_id": 0,
-                "doctor_id": 1,
-                "req_id": "$requests.req_id",
-                "date": "$requests.date",
-                "time": "$requests.time",
-                "user_id": "$requests.user_id"
-            }
-        }
-    ]
-    result = appointment_collection.aggregate(pipeline)
-    elems = list(result)
-    return elems
+
+def get_confirms_user(user_id, start=None, end=None):
+    return get_slots_user(user_id, CONFIRMED, start, end)
 
 
+def get_requests_user(user_id, start=None, end=None):
+    return get_slots_user(user_id, REQUESTED, start, end)
 
 
 class Item(BaseModel):
@@ -904,27 +1084,19 @@ class Item(BaseModel):
     clinicName: str = "clinicName"
 
 
-def get_doctor_info(doct_id: str) -> dict:
-    try:
-        doctor = doctor_collection.find_one(
-            {'_id': ObjectId(doct_id)},
-            {'_id': 0, 'working_days': 0, 'login': 0, 'password': 0}
-            # Исключаем _id из результата
-        )
-        return doctor or {"error": "Doctor not found"}
-    except Exception as e:
-        return {"error": str(e)}
-
-@app.post("/user_confirmed_events", tags=["user"], response_model=list[Item])
-def get_events(token: token1):
+@app.post("/user_confirmed_events", tags=["user"], response_model=Union[list[Item], dict])
+def get_events(token: calendar_window):
+    bounds = parse_window(token)
+    if bounds is None:
+        return invalid_window(token)
+    start, end = bounds
     user_id = str(decodeJWT(token.token).get("user_id"))
-    reqs = get_confirms_user(user_id)
+    reqs = get_confirms_user(user_id, start, end)
     returned = []
     for req in reqs:
-        doct_id = req.get("doctor_id")
         date = req.get("date")
         time = req.get("time")
-        doc = get_doctor_info(doct_id)
+        doc = req.get("doctor") or {}
         con_id = req.get("req_id")
         new = {"start": f'{date}T{time}:00', "end": f'{date}T{time[0]}{time[1]}:30:00', "doc_name": doc.get('name'),
                    "doc_surname": doc.get('surname'), "father_name": doc.get('father_name'),
@@ -934,17 +1106,19 @@ def get_events(token: token1):
 
     return returned
 
-@app.post("/user_requested_events", tags=["user"], response_model=list[Item])
-def get_events(token: token1):
+@app.post("/user_requested_events", tags=["user"], response_model=Union[list[Item], dict])
+def get_events(token: calendar_window):
+    bounds = parse_window(token)
+    if bounds is None:
+        return invalid_window(token)
+    start, end = bounds
     user_id = str(decodeJWT(token.token).get("user_id"))
-    reqs = get_requests_user(user_id)
+    reqs = get_requests_user(user_id, start, end)
     returned = []
     for req in reqs:
-       
-        doct_id = req.get("doctor_id")
         date = req.get("date")
         time = req.get("time")
-        doc = get_doctor_info(doct_id)
+        doc = req.get("doctor") or {}
         req_id = req.get("req_id")
         new = {"start": f'{date}T{time}:00', "doc_name": doc.get('name'), "doc_surname": doc.get('surname'),
                "father_name": doc.get('father_name'), "doc_specialty": doc.get('specialty'),
@@ -957,12 +1131,7 @@ def get_events(token: token1):
 @app.post("/is_rejected", tags=["user"])
 def is_req_id_exists(req_id: str) -> bool:
     # Проверяем наличие в requests или confirms, true - rejected
-    exists = appointment_collection.count_documents({
-        "$or": [
-            {"requests.req_id": req_id},
-            {"confirms.con_id": req_id}
-        ]
-    }, limit=1) > 0
+    exists = slot_collection.count_documents(active_req_id(req_id), limit=1) > 0
     return not exists
 
 
@@ -1006,6 +1175,11 @@ def get_docs_by_clinics(clin: clin_name):
 
 ###################Prompts#####################################################
 
+# GigaChat access token shared by all chat turns, see prompts.TokenManager
+giga_tokens = TokenManager(str(config('auth', default='')),
+                           refresh_margin=config('giga_token_refresh_margin', default=300, cast=int))
+
+
 class prompt(BaseModel):
     token: str
     prompt_text: str
@@ -1014,109 +1188,200 @@ class prompt(BaseModel):
 class prompt_examp(BaseModel):
     response: str
 
-@app.post("/promt_bot", tags=["bot", "user"], response_model=prompt_examp)
-async def send_prompt(pr: prompt):
-    auth = str(config('auth'))
-    response2 = get_token(auth)
-    giga_token = ''
-    
-    if response2 != 1:
-        giga_token = response2.json()['access_token']
-    
-    user_id = str(decodeJWT(pr.token).get("user_id"))
-    
+# Начальная системная подсказка
+SYSTEM_PROMPT = """Вы — ассистент врача. Ваша задача — вести предварительный диалог с пациентом,
+            чтобы понять его жалобы. Сначала спросите 1 или 2 уточняющих вопроса, далее вам будут предоставлятся ответы пациента - задавайте вопросы далее, основанные на ответах пациента.
+            Задавайте короткие, последовательные,
+            вежливые, вопросы о самочувствии и симптомах, нельзя спрашивать сразу много вопросов. 
+            Никогда не ставьте диагноз — скажите,что это сделает только настоящий врач. 
+            После 4-6 вопросов о симптомах - порекомендуйте подходящего специалиста, которму стоит записаться.
+            Нельзя упоминать лекарства - это делает только доктор.
+            В конце диалога всегда говорите: Берегите себя!"""
+
+# Запрос для диагноза в конце беседы
+DIAGNOSIS_PROMPT = (
+    'Определите только симптомы пациента и несколько возможных диагнозов. '
+    'Ответ верните строго в формате JSON: '
+    '{"patient_symptoms": ["список симптомов"], "potential_diagnosis": ["список возможных диагнозов"]} '
+    'Не добавляйте никаких пояснений, текста или символов вне JSON - нельязя писать Берегите себя!.'
+)
+
+# Ограничение по длине беседы
+MAX_CONVERSATION_MESSAGES = 1000
+CONVERSATION_END = 'Это конец нашей беседы. Берегите себя!'
+
+
+# Waits for a GigaChat slot of llm_gate, rejects with 429/503 and Retry-After when saturated
+async def admit_prompt(user_id: str):
+    try:
+        return await llm_gate.acquire(user_id)
+    except Rejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail,
+                            headers={"Retry-After": str(e.retry_after)})
+
+
+async def current_giga_token(deadline: float):
+    try:
+        return await asyncio.wait_for(giga_tokens.get(), deadline - time.monotonic())
+    except (GigaChatError, asyncio.TimeoutError):
+        raise HTTPException(status_code=503, detail="The assistant is unavailable, try again later.",
+                            headers={"Retry-After": "5"})
+
+
+# Возвращает (history, conv): сообщения для GigaChat и беседу с новым
+# сообщением пользователя в конце. В prom_history оно попадает только
+# вместе с ответом, в finish_turn
+def start_turn(user_id: str, prompt_text: str):
     # Проверяем, существует ли история пользователя
     exist = None
     try:
         exist = prom_history.find_one({"user_id": user_id})
     except:
         pass
-    
+
     if exist is None:
         pr_data = {"user_id": user_id, "conv_history": []}
         prom_history.insert_one(pr_data)
-    
-    # Начальная системная подсказка
-    history = [{
-        'role': 'system',
-        'content': (
-            """Вы — ассистент врача. Ваша задача — вести предварительный диалог с пациентом,
-            чтобы понять его жалобы. Сначала спросите 1 или 2 уточняющих вопроса, далее вам будут предоставлятся ответы пациента - задавайте вопросы далее, основанные на ответах пациента.
-            Задавайте короткие, последовательные,
-            вежливые, вопросы о самочувствии и симптомах, нельзя спрашивать сразу много вопросов. 
-            Никогда не ставьте диагноз — скажите,что это сделает только настоящий врач. 
-            После 4-6 вопросов о симптомах - порекомендуйте подходящего специалиста, которму стоит записаться.
-            Нельзя упоминать лекарства - это делает только доктор.
-            В конце диалога всегда говорите: Берегите себя!"""
-        )
-    }]
-    
-    # Добавляем сообщение пользователя в историю
-    updated_prom = prom_history.update_one(
-        {"user_id": user_id},
-        {"$push": {"conv_history": {"role": "user", "content": pr.prompt_text}}}
-    )
-    
-    strings = 0
-    his = prom_history.find_one({"user_id": user_id})
-    t = datetime.today().strftime("d%d-%m t%H_%M")
-    
+
+    history = [{'role': 'system', 'content': SYSTEM_PROMPT}]
+
     # Получаем историю сообщений
+    conv = []
     try:
-        conv = prom_helper(his)
-        for el in conv:
-            history.append(el)
-            strings += 1
+        conv = list(prom_helper(exist))
     except:
         pass
-    
-    # Ограничение по длине беседы
-    if strings <= 1000:
-        response = get_chat_completion(giga_token, history)
-        resp_data = response.json()['choices'][0]['message']['content']
-        resp_data = resp_data.replace('\n\n', '\n')
-    else:
-        resp_data = 'Это конец нашей беседы. Берегите себя!'
-    
-    # Добавляем ответ ассистента в историю
-    updated_prom = prom_history.update_one(
+    conv.append({"role": "user", "content": prompt_text})
+    history.extend(conv)
+    return history, conv
+
+
+# Добавляет сообщение пользователя и ответ ассистента в историю, а в конце
+# беседы сохраняет её вместе с симптомами и диагнозами в файл и в users_collection.
+# Диагноз укладывается в то, что осталось от deadline хода
+async def finish_turn(user_id: str, history: list, conv: list, resp_data: str, deadline: float):
+    t = datetime.today().strftime("d%d-%m t%H_%M")
+    prom_history.update_one(
         {"user_id": user_id},
-        {"$push": {"conv_history": {"role": "assistant", "content": resp_data}}}
+        {"$push": {"conv_history": {"$each": [conv[-1], {"role": "assistant", "content": resp_data}]}}}
     )
-    
+
     # Сохраняем финальную беседу в файл и базу
     if 'Берегите себя!' in resp_data:
         with open("demofile2.txt", "a") as f:
             conv.append({"role": "assistant", "content": resp_data})
             fileinput = [{"convo": conv}]
-            
-            # Формируем запрос для диагноза
-            history.append({
-                'role': 'user',
-                'content': (
-                    'Определите только симптомы пациента и несколько возможных диагнозов. '
-                    'Ответ верните строго в формате JSON: '
-                    '{"patient_symptoms": ["список симптомов"], "potential_diagnosis": ["список возможных диагнозов"]} '
-                    'Не добавляйте никаких пояснений, текста или символов вне JSON - нельязя писать Берегите себя!.'
-                )
-            })
-            
-            diag = get_chat_completion(giga_token, history)
-            fileinput.append(diag.json()['choices'][0]['message']['content'])
+
+            history.append({'role': 'user', 'content': DIAGNOSIS_PROMPT})
+
+            try:
+                diag = await complete_chat(giga_tokens, history, deadline)
+            except GigaChatError:
+                # беседа сохраняется и без диагноза
+                diag = json.dumps({"patient_symptoms": [], "potential_diagnosis": []}, ensure_ascii=False)
+            fileinput.append(diag)
             f.write(str(fileinput) + '\n' + '-------------------------------------------------------------------' + "\n")
-        
+
         # Удаляем историю пользователя из временной коллекции
         prom_history.delete_one({"user_id": user_id})
-        
+
         # Сохраняем в основную коллекцию пользователя
         user_collection.update_one(
             {"_id": ObjectId(user_id)},
             {"$push": {"convos": {'filename': t, 'convo': fileinput}}}
         )
-    
+
+
+@app.post("/promt_bot", tags=["bot", "user"], response_model=prompt_examp)
+async def send_prompt(pr: prompt):
+    # бюджет хода считается с прихода запроса, включая ожидание в очереди
+    deadline = time.monotonic() + TURN_DEADLINE
+    user_id = str(decodeJWT(pr.token).get("user_id"))
+    admitted_at = await admit_prompt(user_id)
+    try:
+        history, conv = start_turn(user_id, pr.prompt_text)
+
+        if len(conv) <= MAX_CONVERSATION_MESSAGES:
+            try:
+                resp_data = await complete_chat(giga_tokens, history, deadline)
+            except GigaChatError as e:
+                # сообщение пользователя не сохранено, его можно просто отправить ещё раз
+                raise HTTPException(status_code=503, detail="The assistant is unavailable, try again later.",
+                                    headers={"Retry-After": str(e.retry_after if isinstance(e, CircuitOpen) else 5)})
+            resp_data = resp_data.replace('\n\n', '\n')
+        else:
+            resp_data = CONVERSATION_END
+
+        await finish_turn(user_id, history, conv, resp_data, deadline)
+    finally:
+        llm_gate.release(user_id, admitted_at)
+
     # Возвращаем первый абзац ответа
     return {'response': resp_data.split('\n', 1)[0]}
 
+
+def sse_event(data: dict, event: str = None):
+    head = f"event: {event}\n" if event else ""
+    return f"{head}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+# Фрагменты ответа уходят клиенту событиями {"delta": ...} по мере прихода,
+# полный текст сохраняется в prom_history и приходит последним событием "done".
+# Поток ограничен сроком хода: медленный ответ не держит слот llm_gate дольше.
+async def prompt_event_stream(user_id: str, giga_token: str, history: list, conv: list, deadline: float):
+    if len(conv) <= MAX_CONVERSATION_MESSAGES:
+        chunks = []
+        stream = stream_chat_completion(giga_token, history)
+        try:
+            while True:
+                try:
+                    delta = await asyncio.wait_for(stream.__anext__(), max(0, deadline - time.monotonic()))
+                except StopAsyncIteration:
+                    break
+                chunks.append(delta)
+                yield sse_event({"delta": delta})
+        except (GigaChatError, asyncio.TimeoutError) as e:
+            if isinstance(e, TokenRejected):
+                # the next stream fetches a fresh token
+                giga_tokens.invalidate()
+            elif isinstance(e, asyncio.TimeoutError):
+                gigachat_breaker.failure()
+            yield sse_event({"detail": "The assistant is unavailable, try again later."}, "error")
+            return
+        finally:
+            await stream.aclose()
+        resp_data = ''.join(chunks).replace('\n\n', '\n')
+    else:
+        resp_data = CONVERSATION_END
+        yield sse_event({"delta": resp_data})
+
+    await finish_turn(user_id, history, conv, resp_data, deadline)
+    yield sse_event({"response": resp_data}, "done")
+
+
+@app.post("/promt_bot_stream", tags=["bot", "user"])
+async def send_prompt_stream(pr: prompt):
+    deadline = time.monotonic() + TURN_DEADLINE
+    decoded = decodeJWT(pr.token)
+    if not decoded:
+        raise HTTPException(status_code=403, detail="Invalid token or expired token.")
+    if gigachat_breaker.state() == "open":
+        raise HTTPException(status_code=503, detail="The assistant is unavailable, try again later.",
+                            headers={"Retry-After": str(int(gigachat_breaker.reset_timeout))})
+    user_id = str(decoded.get("user_id"))
+    admitted_at = await admit_prompt(user_id)
+    try:
+        giga_token = await current_giga_token(deadline)
+        history, conv = start_turn(user_id, pr.prompt_text)
+    except BaseException:
+        llm_gate.release(user_id, admitted_at)
+        raise
+    # the llm_gate slot is held until the response is over, streamed or not
+    return ClosingStreamingResponse(prompt_event_stream(user_id, giga_token, history, conv, deadline),
+                                    on_close=lambda: llm_gate.release(user_id, admitted_at),
+                                    media_type="text/event-stream",
+                                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 class pdflist(BaseModel):
     user_id: str
 
@@ -1,9 +1,78 @@
-import requests
+import httpx
 import uuid
 import json
+import time
+import asyncio
+import random
+from contextlib import asynccontextmanager
+from decouple import config
 
 
-def get_token(auth_token, scope='GIGACHAT_API_PERS'):
+class GigaChatClient:
+    """
+      Общий асинхронный HTTP-клиент для GigaChat.
+
+      Держит пул keep-alive соединений, ограничивает время соединения и
+      чтения и число одновременных запросов (остальные ждут в семафоре).
+      Клиент создаётся при первом запросе и закрывается в lifespan приложения.
+      """
+
+    def __init__(self, max_connections=20, concurrency=10, connect_timeout=5.0, read_timeout=60.0):
+        self.max_connections = max_connections
+        self.concurrency = concurrency
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.in_flight = 0
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None or self._client.is_closed:
+            # (можно скачать сертификаты Минцифры, тогда отключать проверку не надо)
+            self._client = httpx.AsyncClient(
+                verify=False,
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections),
+            )
+        return self._client
+
+    async def post(self, url, **kwargs):
+        async with self._semaphore:
+            self.in_flight += 1
+            try:
+                return await self.client.post(url, **kwargs)
+            finally:
+                self.in_flight -= 1
+
+    @asynccontextmanager
+    async def stream(self, url, **kwargs):
+        async with self._semaphore:
+            self.in_flight += 1
+            try:
+                async with self.client.stream("POST", url, **kwargs) as response:
+                    yield response
+            finally:
+                self.in_flight -= 1
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self):
+        return {"in_flight": self.in_flight, "concurrency": self.concurrency}
+
+
+gigachat = GigaChatClient(
+    max_connections=config('gigachat_max_connections', default=20, cast=int),
+    concurrency=config('gigachat_concurrency', default=10, cast=int),
+    connect_timeout=config('gigachat_connect_timeout', default=5, cast=float),
+    read_timeout=config('gigachat_read_timeout', default=60, cast=float),
+)
+
+
+async def get_token(auth_token, scope='GIGACHAT_API_PERS'):
     """
       Выполняет POST-запрос к эндпоинту, который выдает токен.
 
@@ -34,11 +103,10 @@ def get_token(auth_token, scope='GIGACHAT_API_PERS'):
     }
 
     try:
-        # Делаем POST запрос с отключенной SSL верификацией
-        # (можно скачать сертификаты Минцифры, тогда отключать проверку не надо)
-        response = requests.post(url, headers=headers, data=payload, verify=False)
+        # Делаем POST запрос через общий клиент (SSL верификация отключена)
+        response = await gigachat.post(url, headers=headers, data=payload)
         return response
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"Ошибка: {str(e)}")
         return -1
 
@@ -46,30 +114,33 @@ def get_token(auth_token, scope='GIGACHAT_API_PERS'):
      
      
      
-def get_chat_completion(auth_token, conversation_history=None):
+# URL API, к которому мы обращаемся
+CHAT_URL = "https://gigachat.devices.sberbank.ru/api/v1/chat/completions"
 
-    # URL API, к которому мы обращаемся
-    url = "https://gigachat.devices.sberbank.ru/api/v1/chat/completions"
 
-    # Если история диалога не предоставлена, инициализируем пустым списком
-    if conversation_history is None:
-        conversation_history = []
-
-    # Добавляем сообщение пользователя в историю диалога
- 
+def completion_payload(conversation_history, stream=False):
     # Подготовка данных запроса в формате JSON
-    payload = json.dumps({
+    return json.dumps({
         "model": "GigaChat:latest",
         "messages": conversation_history,
         "temperature": 1,
         "top_p": 0.1,
         "n": 1,
-        "stream": False,
+        "stream": stream,
         "max_tokens": 512,
         "repetition_penalty": 1,
         "update_interval": 0
     })
 
+
+async def get_chat_completion(auth_token, conversation_history=None):
+
+    # Если история диалога не предоставлена, инициализируем пустым списком
+    if conversation_history is None:
+        conversation_history = []
+
+    payload = completion_payload(conversation_history)
+
     # Заголовки запроса
     headers = {
         'Content-Type': 'application/json',
@@ -79,8 +150,253 @@ def get_chat_completion(auth_token, conversation_history=None):
 
     # Выполнение POST-запроса и возвращение ответа
     try:
-        response = requests.post(url, headers=headers, data=payload, verify=False)
-    except requests.RequestException as e:
+        response = await gigachat.post(CHAT_URL, headers=headers, content=payload)
+    except httpx.HTTPError as e:
         # Обработка исключения в случае ошибки запроса
         print(f"Произошла ошибка: {str(e)}")
+        return -1
     return response
+
+
+async def stream_chat_completion(auth_token, conversation_history):
+    """
+      Потоковый вариант get_chat_completion ("stream": true).
+
+      Асинхронный генератор фрагментов ответа по мере их прихода от GigaChat.
+      Ошибки соединения, ответы не 200 и нечитаемые события поднимаются как
+      GigaChatError, ответ 401 - как TokenRejected.
+      """
+    gigachat_breaker.before_call()
+    headers = {
+        'Content-Type': 'application/json',
+        'Accept': 'text/event-stream',
+        'Authorization': f'Bearer {auth_token}'
+    }
+    try:
+        async with gigachat.stream(CHAT_URL, headers=headers,
+                                   content=completion_payload(conversation_history, stream=True)) as response:
+            if response.status_code in RETRYABLE_STATUSES:
+                gigachat_breaker.failure()
+                raise GigaChatError(f"completion failed: {response.status_code}")
+            # сервис отвечает, даже если запрос не принят
+            gigachat_breaker.success()
+            if response.status_code == 401:
+                raise TokenRejected("access token rejected")
+            if response.status_code != 200:
+                raise GigaChatError(f"completion failed: {response.status_code}")
+            # Ответ приходит как server-sent events: "data: {...}", в конце "data: [DONE]"
+            async for line in response.aiter_lines():
+                if not line.startswith('data:'):
+                    continue
+                data = line[len('data:'):].strip()
+                if data == '[DONE]':
+                    break
+                try:
+                    delta = json.loads(data)['choices'][0].get('delta', {}).get('content')
+                except (ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+                    gigachat_breaker.failure()
+                    raise GigaChatError(f"malformed completion event: {e}") from e
+                if delta:
+                    yield delta
+    except httpx.HTTPError as e:
+        gigachat_breaker.failure()
+        raise GigaChatError(str(e)) from e
+
+
+class GigaChatError(Exception):
+    pass
+
+
+class TokenRejected(GigaChatError):
+    pass
+
+
+class TokenManager:
+    """
+      Общий кэш access token GigaChat.
+
+      Токен живёт до expires_at из ответа OAuth (в миллисекундах). За
+      refresh_margin секунд до истечения он обновляется в фоне, а запросы
+      продолжают получать ещё действующий токен. Одновременные обновления
+      объединяются в один запрос к ngw.devices.sberbank.ru.
+      """
+
+    def __init__(self, auth_token, scope='GIGACHAT_API_PERS', refresh_margin=300):
+        self.auth_token = auth_token
+        self.scope = scope
+        self.refresh_margin = refresh_margin
+        self.refreshes = 0
+        self.failures = 0
+        self._token = None
+        self._expires_at = 0
+        self._refresh = None
+
+    async def get(self):
+        now = time.time()
+        if self._token and now < self._expires_at:
+            if now >= self._expires_at - self.refresh_margin:
+                self._start_refresh()
+            return self._token
+        return await asyncio.shield(self._start_refresh())
+
+    def invalidate(self):
+        self._token = None
+
+    def _start_refresh(self):
+        if self._refresh is None or self._refresh.done():
+            self._refresh = asyncio.ensure_future(self._fetch())
+            self._refresh.add_done_callback(self._refreshed)
+        return self._refresh
+
+    async def _fetch(self):
+        response = await get_token(self.auth_token, self.scope)
+        if response == -1 or response.status_code != 200:
+            raise GigaChatError(f"token request failed: {getattr(response, 'status_code', response)}")
+        try:
+            data = response.json()
+            token, expires_at = data['access_token'], data['expires_at'] / 1000
+        except (ValueError, KeyError, TypeError) as e:
+            raise GigaChatError(f"malformed token response: {e}") from e
+        self._token = token
+        self._expires_at = expires_at
+        return self._token
+
+    def _refreshed(self, task):
+        if task.cancelled() or task.exception() is not None:
+            self.failures += 1
+        else:
+            self.refreshes += 1
+
+    def stats(self):
+        return {
+            "valid_for": max(0, int(self._expires_at - time.time())) if self._token else 0,
+            "refreshes": self.refreshes,
+            "failures": self.failures,
+        }
+
+
+class CircuitOpen(GigaChatError):
+    def __init__(self, retry_after):
+        super().__init__("GigaChat is unavailable")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+      Размыкается после failure_threshold сбоев подряд: следующие reset_timeout
+      секунд вызовы сразу получают CircuitOpen, не дожидаясь таймаутов. Затем
+      пропускается один пробный вызов, его успех замыкает цепь снова.
+      """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.trips = 0
+        self._opened_at = None
+        self._probe_at = None
+
+    def state(self):
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at < self.reset_timeout:
+            return "open"
+        return "half_open"
+
+    def before_call(self):
+        state = self.state()
+        now = time.monotonic()
+        # a probe that never reported back (e.g. cancelled) expires after reset_timeout
+        probing = self._probe_at is not None and now - self._probe_at < self.reset_timeout
+        if state == "open":
+            raise CircuitOpen(max(1, int(self.reset_timeout - (now - self._opened_at)) + 1))
+        if state == "half_open":
+            if probing:
+                raise CircuitOpen(1)
+            self._probe_at = now
+
+    def success(self):
+        self.failures = 0
+        self._opened_at = None
+        self._probe_at = None
+
+    def failure(self):
+        self.failures += 1
+        self._probe_at = None
+        if self.failures >= self.failure_threshold:
+            if self._opened_at is None or self.state() == "half_open":
+                self.trips += 1
+            self._opened_at = time.monotonic()
+
+    def stats(self):
+        return {"state": self.state(), "failures": self.failures, "trips": self.trips}
+
+
+gigachat_breaker = CircuitBreaker(
+    failure_threshold=config('gigachat_breaker_failures', default=5, cast=int),
+    reset_timeout=config('gigachat_breaker_reset', default=30, cast=float),
+)
+
+# Ответы, после которых запрос можно безопасно повторить
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+RETRY_ATTEMPTS = config('gigachat_retry_attempts', default=3, cast=int)
+RETRY_BASE_DELAY = config('gigachat_retry_base_delay', default=0.5, cast=float)
+RETRY_MAX_DELAY = config('gigachat_retry_max_delay', default=4, cast=float)
+# Бюджет времени на один ход беседы, включая повторы
+TURN_DEADLINE = config('gigachat_turn_deadline', default=45, cast=float)
+
+
+async def authorized_completion(tokens, conversation_history):
+    # Токен и ответ под одним сроком: получение токена тоже входит в бюджет хода
+    token = await tokens.get()
+    return await get_chat_completion(token, conversation_history)
+
+
+async def complete_chat(tokens, conversation_history, deadline):
+    """
+      Текст ответа GigaChat с повторами и общим сроком.
+
+      Сбои соединения, таймауты и ответы из RETRYABLE_STATUSES повторяются
+      с экспоненциальной задержкой со случайной составляющей, пока не
+      кончатся попытки или не наступит deadline (по time.monotonic()). Ответ
+      401 сбрасывает токен. Всё остальное, как и разомкнутый
+      gigachat_breaker, поднимается как GigaChatError.
+      """
+    for attempt in range(RETRY_ATTEMPTS):
+        gigachat_breaker.before_call()
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            response = await asyncio.wait_for(authorized_completion(tokens, conversation_history), remaining)
+        except asyncio.TimeoutError:
+            gigachat_breaker.failure()
+            break
+        except GigaChatError:
+            # токен не получен
+            gigachat_breaker.failure()
+            response = -1
+
+        if response != -1 and response.status_code == 200:
+            try:
+                content = response.json()['choices'][0]['message']['content']
+            except (ValueError, KeyError, IndexError, TypeError) as e:
+                gigachat_breaker.failure()
+                raise GigaChatError(f"malformed completion: {e}") from e
+            gigachat_breaker.success()
+            return content
+        if response != -1 and response.status_code == 401:
+            gigachat_breaker.success()
+            tokens.invalidate()
+        elif response == -1 or response.status_code in RETRYABLE_STATUSES:
+            gigachat_breaker.failure()
+        else:
+            # сервис отвечает, повтор не поможет
+            gigachat_breaker.success()
+            raise GigaChatError(f"completion failed: {response.status_code}")
+
+        delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+        if attempt + 1 == RETRY_ATTEMPTS or time.monotonic() + delay >= deadline:
+            break
+        await asyncio.sleep(delay)
+    raise GigaChatError("completion failed after retries")
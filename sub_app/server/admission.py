@@ -0,0 +1,126 @@
+import asyncio
+import math
+import time
+from collections import defaultdict, deque
+
+from decouple import config
+
+
+class Rejected(Exception):
+    def __init__(self, status_code: int, detail: str, retry_after: int):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class AdmissionGate:
+    """Bounded concurrency with a FIFO queue, for endpoints backed by GigaChat.
+
+    At most max_concurrency callers run at once, the rest wait in arrival
+    order. A caller is rejected right away when it already has per_user calls
+    in flight (429) or the queue holds max_queue callers (503), and after
+    max_wait seconds in the queue (503). Retry-After is estimated from the
+    recent service time. Must be used from the event loop thread.
+    """
+
+    def __init__(self, max_concurrency: int = 8, max_queue: int = 100, max_wait: float = 10,
+                 per_user: int = 1):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.per_user = per_user
+        self.active = 0
+        self.admitted = 0
+        self.rejected = defaultdict(int)
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.service_time = 1.0
+        self._waiters = deque()
+        self._in_flight = defaultdict(int)
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self.service_time * (len(self._waiters) + 1) / self.max_concurrency))
+
+    async def acquire(self, key: str):
+        """Waits for a slot, returns the admission time to pass to release."""
+        if self._in_flight[key] >= self.per_user:
+            self.rejected["user"] += 1
+            raise Rejected(429, "Too many requests in progress.", self.retry_after())
+        self._in_flight[key] += 1
+        try:
+            waited = await self._acquire_slot()
+        except BaseException:
+            self._forget(key)
+            raise
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        self.admitted += 1
+        return time.monotonic()
+
+    async def _acquire_slot(self) -> float:
+        started = time.monotonic()
+        if self.active < self.max_concurrency and not self._waiters:
+            self.active += 1
+            return 0.0
+        if len(self._waiters) >= self.max_queue:
+            self.rejected["queue_full"] += 1
+            raise Rejected(503, "The assistant is busy, try again later.", self.retry_after())
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was handed over just as the wait ended
+                if isinstance(e, asyncio.CancelledError):
+                    self._release_slot()
+                    raise
+            else:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                self.rejected["timeout"] += 1
+                raise Rejected(503, "The assistant is busy, try again later.", self.retry_after())
+        return time.monotonic() - started
+
+    def release(self, key: str, admitted_at: float = None):
+        if admitted_at is not None:
+            # moving average of how long a call holds its slot
+            self.service_time = 0.8 * self.service_time + 0.2 * (time.monotonic() - admitted_at)
+        self._forget(key)
+        self._release_slot()
+
+    def _forget(self, key: str):
+        self._in_flight[key] -= 1
+        if self._in_flight[key] <= 0:
+            del self._in_flight[key]
+
+    def _release_slot(self):
+        # hand the slot to the oldest waiter that still waits, active stays the same
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "queue_depth": len(self._waiters),
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+            "wait_avg_ms": round(1000 * self.wait_total / self.admitted, 1) if self.admitted else 0,
+            "wait_max_ms": round(1000 * self.wait_max, 1),
+            "service_time_ms": round(1000 * self.service_time, 1),
+        }
+
+
+llm_gate = AdmissionGate(
+    max_concurrency=config("llm_max_concurrency", default=8, cast=int),
+    max_queue=config("llm_max_queue", default=100, cast=int),
+    max_wait=config("llm_max_wait", default=10, cast=float),
+    per_user=config("llm_per_user", default=1, cast=int),
+)
@@ -0,0 +1,93 @@
+"""Free-slot computation from working_days and bookings.
+
+A day is split into 48 slots of 30 minutes. Working hours and bookings are
+both kept as int bitmasks over those slots (bit i is the slot starting at
+i * 30 minutes), so free time is working & ~taken.
+"""
+import re
+from datetime import datetime
+
+from decouple import config
+
+from sub_app.server.cache import TTLCache
+
+SLOT_MINUTES = 30
+SLOTS_PER_DAY = 24 * 60 // SLOT_MINUTES
+
+# working_days keys as they appear in DoctorSchema/ClinicSchema, including the
+# "Suturday" spelling of the schema example
+WEEKDAYS = {
+    "monday": 0, "mon": 0, "понедельник": 0, "пн": 0,
+    "tuesday": 1, "tue": 1, "вторник": 1, "вт": 1,
+    "wednesday": 2, "wed": 2, "среда": 2, "ср": 2,
+    "thursday": 3, "thu": 3, "четверг": 3, "чт": 3,
+    "friday": 4, "fri": 4, "пятница": 4, "пт": 4,
+    "saturday": 5, "suturday": 5, "sat": 5, "суббота": 5, "сб": 5,
+    "sunday": 6, "sun": 6, "воскресенье": 6, "вс": 6,
+}
+
+INTERVAL = re.compile(r"(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})")
+
+
+def slot_index(hour: int, minute: int) -> int:
+    return (hour * 60 + minute) // SLOT_MINUTES
+
+
+def time_slot(time: str) -> int:
+    hour, minute = time.split(":")
+    return slot_index(int(hour), int(minute))
+
+
+def slot_time(index: int) -> str:
+    minutes = index * SLOT_MINUTES
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+def interval_mask(hours: str) -> int:
+    """Slots fully inside intervals like "10:00-15:00" or "9:00-13:00, 14:00-18:00"."""
+    mask = 0
+    for h1, m1, h2, m2 in INTERVAL.findall(hours or ""):
+        first = -(-(int(h1) * 60 + int(m1)) // SLOT_MINUTES)  # round up to the next slot boundary
+        last = slot_index(int(h2), int(m2))
+        for i in range(first, min(last, SLOTS_PER_DAY)):
+            mask |= 1 << i
+    return mask
+
+
+def parse_working_days(working_days) -> tuple:
+    """Per-weekday (Monday first) masks of working slots.
+
+    working_days is a {weekday: hours} dict; a bare hours string applies to
+    every day of the week, anything else means no working hours.
+    """
+    if isinstance(working_days, str):
+        return (interval_mask(working_days),) * 7
+    if not isinstance(working_days, dict):
+        return (0,) * 7
+    week = [0] * 7
+    for day, hours in working_days.items():
+        weekday = WEEKDAYS.get(str(day).strip().lower())
+        if weekday is not None and isinstance(hours, str):
+            week[weekday] |= interval_mask(hours)
+    return tuple(week)
+
+
+def mask_times(mask: int, not_before: int = 0) -> list:
+    return [slot_time(i) for i in range(not_before, SLOTS_PER_DAY) if mask >> i & 1]
+
+
+def free_times(mask: int, day, now: datetime = None) -> list:
+    """Free slot times of a day's mask, without the ones already past today."""
+    now = now or datetime.now()
+    if not mask or day < now.date():
+        return []
+    not_before = slot_index(now.hour, now.minute) + 1 if day == now.date() else 0
+    return mask_times(mask, not_before)
+
+
+# doctor_id -> parsed working week
+working_week_cache = TTLCache(maxsize=config("availability_cache_size", default=50000, cast=int),
+                              ttl=config("working_week_cache_ttl", default=600, cast=float))
+# (doctor_id, date) -> free mask, invalidated on booking changes
+free_slots_cache = TTLCache(maxsize=config("availability_cache_size", default=50000, cast=int),
+                            ttl=config("free_slots_cache_ttl", default=300, cast=float))
@@ -0,0 +1,77 @@
+import threading
+import time
+from collections import OrderedDict
+
+from decouple import config
+
+
+class TTLCache:
+    """Bounded LRU cache whose entries expire ttl seconds after being stored."""
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class PrincipalCache(TTLCache):
+    """Principals verified by decodeJWT / decodeJWT_doc.
+
+    Keys are (kind, id) pairs, where kind is "user" or "doctor"; values are
+    the slim profiles returned by the lookup.
+    """
+
+    def get(self, kind: str, id: str):
+        return super().get((kind, id))
+
+    def put(self, kind: str, id: str, value):
+        super().put((kind, id), value)
+
+    def invalidate(self, kind: str, id: str):
+        super().invalidate((kind, id))
+
+
+principal_cache = PrincipalCache(
+    maxsize=config("principal_cache_size", default=10000, cast=int),
+    ttl=config("principal_cache_ttl", default=60, cast=float),
+)
@@ -0,0 +1,73 @@
+import asyncio
+from collections import defaultdict
+
+from decouple import config
+
+
+class Subscription:
+    def __init__(self, key: str, queue_size: int):
+        self.key = key
+        self.queue = asyncio.Queue(maxsize=queue_size)
+
+
+class EventHub:
+    """In-process pub/sub for server-sent events, keyed by doctor id.
+
+    Every subscriber has a bounded queue. A subscriber whose queue is full is
+    dropped (it gets a None sentinel and its stream ends) instead of buffering
+    without limit, clients reconnect and catch up through /events_delta.
+    Must be used from the event loop thread.
+    """
+
+    def __init__(self, queue_size: int = 100, max_subscribers: int = 10):
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self.dropped = 0
+        self.published = 0
+        self._subscribers = defaultdict(set)
+
+    def has_subscribers(self, key: str) -> bool:
+        return bool(self._subscribers.get(key))
+
+    def subscribe(self, key: str):
+        if len(self._subscribers[key]) >= self.max_subscribers:
+            return None
+        sub = Subscription(key, self.queue_size)
+        self._subscribers[key].add(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscription):
+        subs = self._subscribers.get(sub.key)
+        if subs is not None:
+            subs.discard(sub)
+            if not subs:
+                del self._subscribers[sub.key]
+
+    def publish(self, key: str, event: dict):
+        for sub in list(self._subscribers.get(key, ())):
+            try:
+                sub.queue.put_nowait(event)
+                self.published += 1
+            except asyncio.QueueFull:
+                self._drop(sub)
+
+    def _drop(self, sub: Subscription):
+        self.unsubscribe(sub)
+        self.dropped += 1
+        while not sub.queue.empty():
+            sub.queue.get_nowait()
+        sub.queue.put_nowait(None)
+
+    def stats(self) -> dict:
+        return {
+            "doctors": len(self._subscribers),
+            "subscribers": sum(len(subs) for subs in self._subscribers.values()),
+            "published": self.published,
+            "dropped": self.dropped,
+        }
+
+
+event_hub = EventHub(
+    queue_size=config("sse_queue_size", default=100, cast=int),
+    max_subscribers=config("sse_max_subscribers", default=10, cast=int),
+)
@@ -0,0 +1,108 @@
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import OperationFailure
+from rich.console import Console
+
+console = Console()
+
+# Indexes the app relies on, per collection. Applied once at startup by
+# ensure_indexes, request handlers never create indexes themselves.
+INDEXES = {
+    "users_collection": [
+        IndexModel([("login", ASCENDING)], name="login_1", unique=True),
+    ],
+    "doctors_collection": [
+        IndexModel([("login", ASCENDING)], name="login_1", unique=True),
+        IndexModel([("email", ASCENDING)], name="email_1"),
+        IndexModel([("clinic_name", ASCENDING)], name="clinic_name_1"),
+        IndexModel([("specialty", ASCENDING)], name="specialty_1"),
+    ],
+    "slots_collection": [
+        IndexModel([("req_id", ASCENDING)], name="req_id_1", unique=True),
+        # one active appointment per doctor and time
+        IndexModel([("doctor_id", ASCENDING), ("start", ASCENDING)],
+                   name="doctor_id_1_start_1_active", unique=True,
+                   partialFilterExpression={"active": True}),
+        IndexModel([("doctor_id", ASCENDING), ("status", ASCENDING), ("start", ASCENDING)],
+                   name="doctor_id_1_status_1_start_1"),
+        # delta sync of doctor calendars
+        IndexModel([("doctor_id", ASCENDING), ("version", ASCENDING)], name="doctor_id_1_version_1"),
+        # per-user appointment index for user calendars
+        IndexModel([("user_id", ASCENDING), ("status", ASCENDING), ("start", ASCENDING)],
+                   name="user_id_1_status_1_start_1"),
+    ],
+    # per-doctor per-day occupancy bitmaps
+    "occupancy_collection": [
+        IndexModel([("doctor_id", ASCENDING), ("day", ASCENDING)], name="doctor_id_1_day_1", unique=True),
+    ],
+    "clinics_collection": [
+        IndexModel([("name", ASCENDING)], name="name_1"),
+    ],
+    "prom_history": [
+        IndexModel([("user_id", ASCENDING)], name="user_id_1"),
+    ],
+}
+
+
+class UniqueIndexError(Exception):
+    pass
+
+
+async def ensure_indexes(database):
+    """Create the registry's indexes, returns the (collection, name) pairs that failed.
+
+    A failed plain index only costs speed and is logged. Unique indexes are
+    what keeps logins and bookings unique, so when one of them cannot be built
+    (e.g. duplicates already exist) UniqueIndexError is raised once all
+    indexes were tried.
+    """
+    failed = []
+    for collection, models in INDEXES.items():
+        for model in models:
+            try:
+                await database[collection].create_indexes([model])
+            except OperationFailure as e:
+                failed.append((collection, model.document["name"]))
+                console.log(f"index {collection}.{model.document['name']} not created: {e}")
+    unique = {(collection, model.document["name"]) for collection, models in INDEXES.items()
+              for model in models if model.document.get("unique")}
+    broken = [f"{collection}.{name}" for collection, name in failed if (collection, name) in unique]
+    if broken:
+        raise UniqueIndexError(f"unique indexes not created: {', '.join(broken)}")
+    return failed
+
+
+async def index_report(database):
+    """Compare the registry with what the server actually has.
+
+    missing    - declared here but absent on the server
+    undeclared - present on the server but not declared here
+    unused     - declared and present, but never used since the server started
+    """
+    report = {"missing": [], "undeclared": [], "unused": []}
+    for collection, models in INDEXES.items():
+        declared = {model.document["name"] for model in models}
+        existing = set()
+        async for index in database[collection].list_indexes():
+            existing.add(index["name"])
+        existing.discard("_id_")
+
+        report["missing"] += [f"{collection}.{name}" for name in sorted(declared - existing)]
+        report["undeclared"] += [f"{collection}.{name}" for name in sorted(existing - declared)]
+
+        try:
+            async for stat in database[collection].aggregate([{"$indexStats": {}}]):
+                if stat["name"] in declared and stat["accesses"]["ops"] == 0:
+                    report["unused"].append(f"{collection}.{stat['name']}")
+        except OperationFailure:
+            # $indexStats needs the indexStats privilege, skip when we don't have it
+            pass
+    return report
+
+
+async def apply_indexes(database):
+    await ensure_indexes(database)
+    report = await index_report(database)
+    for kind, names in report.items():
+        if names:
+            console.log(f"{kind} indexes: {', '.join(names)}")
+    return report
@@ -0,0 +1,137 @@
+"""Move appointments from the embedded requests/confirms arrays of
+appointments_collection into slots_collection, one document per appointment.
+
+    python -m sub_app.server.migrate_slots [--dry-run] [--drop-embedded] [--recount] [--occupancy]
+
+The migration is idempotent: slots are upserted by req_id, so it can be
+re-run while old clients are still writing to the embedded arrays. Entries
+that double-book a time already held by another active slot are reported
+and skipped, they have to be resolved by hand.
+
+--recount rebuilds users_collection.active_appointments from the active slots.
+Run it once after the migration, while bookings are paused.
+
+--occupancy rebuilds the per-day occupancy bitmaps of occupancy_collection
+from the active slots. Run it once before taken_check and /free_slots start
+reading them, also while bookings are paused.
+"""
+import argparse
+import asyncio
+from datetime import datetime
+
+from bson.int64 import Int64
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from rich.console import Console
+
+from sub_app.server.database import (
+    appointment_collection,
+    slot_collection,
+    user_collection,
+    occupancy_collection,
+    database,
+    REQUESTED,
+    CONFIRMED,
+    slot_start,
+)
+from sub_app.server.indexes import ensure_indexes
+from sub_app.server.availability import slot_index
+
+console = Console()
+
+
+# Normalised date/time strings and start datetime of a legacy entry, None if unparseable
+def slot_times(req_id: str, date: str, time: str):
+    try:
+        start = slot_start(date, time)
+    except (TypeError, ValueError):
+        console.log(f"skipped {req_id}: cannot parse {date!r} {time!r}")
+        return None
+    return {"date": start.strftime("%Y-%m-%d"), "time": start.strftime("%H:%M"), "start": start}
+
+
+def embedded_slots(app) -> list:
+    slots = []
+    entries = [(req, req.get("req_id"), REQUESTED) for req in app.get("requests", [])]
+    entries += [(con, con.get("con_id"), CONFIRMED) for con in app.get("confirms", [])]
+    for entry, req_id, status in entries:
+        times = slot_times(req_id, entry.get("date"), entry.get("time"))
+        if times:
+            slots.append({"req_id": req_id, "doctor_id": app["doctor_id"], "user_id": entry.get("user_id"),
+                          **times, "status": status, "active": True})
+    return slots
+
+
+async def migrate(dry_run: bool = False, drop_embedded: bool = False):
+    await ensure_indexes(database)
+    migrated = 0
+    async for app in appointment_collection.find():
+        slots = embedded_slots(app)
+        conflicts = False
+        if slots and not dry_run:
+            try:
+                await slot_collection.bulk_write(
+                    [UpdateOne({"req_id": slot["req_id"]}, {"$setOnInsert": slot}, upsert=True) for slot in slots],
+                    ordered=False,
+                )
+            except BulkWriteError as e:
+                for error in e.details["writeErrors"]:
+                    slot = slots[error["index"]]
+                    console.log(f"skipped {slot['req_id']}: {slot['date']} {slot['time']} "
+                                f"is already booked with doctor {slot['doctor_id']}")
+                conflicts = True
+        migrated += len(slots)
+        if drop_embedded and not dry_run and not conflicts:
+            await appointment_collection.delete_one({"_id": app["_id"]})
+    console.log(f"{'would migrate' if dry_run else 'migrated'} {migrated} appointments")
+    return migrated
+
+
+async def recount():
+    await user_collection.update_many({}, {"$set": {"active_appointments": 0}})
+    ops = []
+    async for row in slot_collection.aggregate([{"$match": {"active": True}},
+                                                {"$group": {"_id": "$user_id", "n": {"$sum": 1}}}]):
+        ops.append(UpdateOne({"_id": ObjectId(row["_id"])}, {"$set": {"active_appointments": row["n"]}}))
+    if ops:
+        await user_collection.bulk_write(ops, ordered=False)
+    console.log(f"recounted active appointments of {len(ops)} users")
+
+
+async def rebuild_occupancy():
+    taken = {}
+    async for slot in slot_collection.find({"active": True}, {"_id": 0, "doctor_id": 1, "start": 1}):
+        key = (slot["doctor_id"], datetime.combine(slot["start"].date(), datetime.min.time()))
+        taken[key] = taken.get(key, 0) | 1 << slot_index(slot["start"].hour, slot["start"].minute)
+    await occupancy_collection.update_many({}, {"$set": {"taken": Int64(0)}})
+    ops = [UpdateOne({"doctor_id": doctor_id, "day": day}, {"$set": {"taken": Int64(mask)}}, upsert=True)
+           for (doctor_id, day), mask in taken.items()]
+    if ops:
+        await occupancy_collection.bulk_write(ops, ordered=False)
+    console.log(f"rebuilt occupancy of {len(ops)} doctor days")
+
+
+async def run(args):
+    await migrate(args.dry_run, args.drop_embedded)
+    if args.recount and not args.dry_run:
+        await recount()
+    if args.occupancy and not args.dry_run:
+        await rebuild_occupancy()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--drop-embedded", action="store_true",
+                        help="delete appointments_collection documents once their entries are migrated")
+    parser.add_argument("--recount", action="store_true",
+                        help="rebuild users_collection.active_appointments from active slots")
+    parser.add_argument("--occupancy", action="store_true",
+                        help="rebuild occupancy_collection bitmaps from active slots")
+    args = parser.parse_args(argv)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""Filters, projections and pipelines of the queries of main.py and database.py.
+
+They are built here, in one place, so query_plans explains exactly the
+shapes the app sends. Keep this module free of settings and connections so
+the plan check can import it on its own.
+"""
+from datetime import timedelta
+
+# Narrow projections for principal lookups
+user_auth_projection = {"login": 1}
+user_card_projection = {"name": 1, "birth": 1, "phone": 1}
+user_profile_projection = {"password": 0}
+credentials_projection = {"password": 1}
+doctor_auth_projection = {"login": 1}
+doctor_profile_projection = {"password": 0}
+doctor_for_user_projection = {"name": 1, "surname": 1, "father_name": 1, "email": 1, "specialty": 1,
+                              "working_days": 1}
+# Doctor cards joined into user calendars, and returned by doctor searches
+doctor_event_projection = {"_id": 0, "name": 1, "surname": 1, "father_name": 1, "specialty": 1, "email": 1,
+                           "clinic_name": 1}
+doctor_search_projection = {"name": 1, "surname": 1, "father_name": 1, "email": 1, "specialty": 1,
+                            "clinic_name": 1, "working_days": 1}
+# What working weeks are parsed from
+doctor_week_projection = {"working_days": 1, "clinic_name": 1}
+clinic_week_projection = {"name": 1, "working_days": 1}
+
+# Appointment statuses in slots_collection, one document per appointment
+REQUESTED = "requested"
+CONFIRMED = "confirmed"
+REJECTED = "rejected"
+ACTIVE = [REQUESTED, CONFIRMED]
+
+
+def window_query(query: dict, start=None, end=None):
+    if start or end:
+        query["start"] = {}
+        if start:
+            query["start"]["$gte"] = start
+        if end:
+            query["start"]["$lt"] = end
+    return query
+
+
+# Appointments of a doctor with the given status, optionally limited to [start, end)
+def doctor_slots(doctor_id: str, status: str, start=None, end=None) -> dict:
+    return window_query({"doctor_id": doctor_id, "status": status}, start, end)
+
+
+# Appointments of a user with the given status, optionally limited to [start, end)
+def user_slots(user_id: str, status: str, start=None, end=None) -> dict:
+    return window_query({"user_id": user_id, "status": status}, start, end)
+
+
+# user_slots in start order, each joined with its doctor's card as "doctor"
+def user_calendar(user_id: str, status: str, start=None, end=None) -> list:
+    return [
+        {"$match": user_slots(user_id, status, start, end)},
+        {"$sort": {"start": 1}},
+        {"$lookup": {
+            "from": "doctors_collection",
+            "let": {"doctor_oid": {"$convert": {"input": "$doctor_id", "to": "objectId", "onError": None}}},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$_id", "$$doctor_oid"]}}},
+                {"$project": doctor_event_projection},
+            ],
+            "as": "doctor",
+        }},
+        {"$project": {"_id": 0, "doctor_id": 1, "req_id": 1, "date": 1, "time": 1, "user_id": 1,
+                      "doctor": {"$arrayElemAt": ["$doctor", 0]}}},
+    ]
+
+
+# Every slot of a doctor; sorted by NEWEST_VERSION, the first one carries the
+# doctor's current calendar version
+def doctor_calendar(doctor_id: str) -> dict:
+    return {"doctor_id": doctor_id}
+
+
+NEWEST_VERSION = [("version", -1)]
+
+
+# Slots changed after version `after`, or every active slot for a full load (after=None)
+def calendar_changes(doctor_id: str, after=None) -> dict:
+    if after is None:
+        return {"doctor_id": doctor_id, "status": {"$in": ACTIVE}}
+    return {"doctor_id": doctor_id, "version": {"$gt": after}}
+
+
+def pending_slot(req_id: str, doctor_id: str) -> dict:
+    return {"req_id": req_id, "doctor_id": doctor_id, "status": REQUESTED}
+
+
+def doctor_slots_by_ids(doctor_id: str, req_ids: list) -> dict:
+    return {"doctor_id": doctor_id, "req_id": {"$in": req_ids}}
+
+
+def slots_with_version(req_ids: list, version: int) -> dict:
+    return {"req_id": {"$in": req_ids}, "version": version}
+
+
+def active_req_id(req_id: str) -> dict:
+    return {"req_id": req_id, "status": {"$in": ACTIVE}}
+
+
+# Active slots of a doctor starting in [since, since + minutes)
+def active_slots_between(doctor_id: str, since, minutes: int) -> dict:
+    return {"doctor_id": doctor_id, "active": True,
+            "start": {"$gte": since, "$lt": since + timedelta(minutes=minutes)}}
+
+
+def occupancy_day(doctor_id: str, day) -> dict:
+    return {"doctor_id": doctor_id, "day": day}
+
+
+# Occupancy documents of one or many doctors for the days in [since, until)
+def occupancy_range(doctor_ids: list, since, until) -> dict:
+    return {"doctor_id": doctor_ids[0] if len(doctor_ids) == 1 else {"$in": doctor_ids},
+            "day": {"$gte": since, "$lt": until}}
+
+
+# The user, if they still have quota left; the filter of the quota $inc
+def quota_left(user_oid, max_active: int) -> dict:
+    return {"_id": user_oid, "$or": [{"active_appointments": {"$lt": max_active}},
+                                     {"active_appointments": {"$exists": False}}]}
@@ -0,0 +1,282 @@
+"""Query-plan regression check for the Mongo queries issued by main.py and database.py.
+
+Seeds a synthetic dataset into a scratch database on a local mongod, applies
+the index registry and runs explain() on every query shape the app issues.
+A shape fails when its winning plan contains a COLLSCAN or a blocking SORT,
+or when it examines more than --ratio times the documents it returns.
+
+    python -m sub_app.server.query_plans --uri mongodb://localhost:27017
+
+Filters, projections and pipelines come from sub_app.server.queries, the
+same builders the app uses; keep SHAPES listing every call site of them.
+"""
+import argparse
+import random
+import string
+import sys
+from datetime import datetime, timedelta
+
+from pymongo import MongoClient
+from rich.console import Console
+
+from sub_app.server.indexes import INDEXES
+from sub_app.server import queries as q
+
+console = Console()
+
+DOCTORS = 200
+USERS = 2000
+BOOKINGS_PER_DOCTOR = 40
+
+
+def random_key():
+    alphabet = string.ascii_letters + string.digits
+    return ''.join(random.choice(alphabet) for _ in range(24))
+
+
+def seed(db):
+    random.seed(7)
+    users = [{"name": f"user{i}", "birth": "01.01.2000", "login": f"user{i}@mail.ru", "password": "x",
+              "phone": "89000000000", "doctors_ids": [], "address": '', "main_doctor_id": '',
+              "history": [], "convos": []} for i in range(USERS)]
+    user_ids = [str(i) for i in db["users_collection"].insert_many(users).inserted_ids]
+
+    doctors = [{"name": f"doc{i}", "surname": "s", "father_name": "f", "specialty": f"spec{i % 10}",
+                "working_days": {"Monday": "10:00-15:00"}, "email": f"doc{i}@mail.ru", "login": f"doc{i}",
+                "password": "x", "clinic_name": f"clinic{i % 20}"} for i in range(DOCTORS)]
+    doctor_ids = [str(i) for i in db["doctors_collection"].insert_many(doctors).inserted_ids]
+
+    slots = []
+    for doctor_id in doctor_ids:
+        for n in range(BOOKINGS_PER_DOCTOR):
+            start = datetime(2024, 4, n % 28 + 1, 10 + n % 6)
+            slots.append({"req_id": random_key(), "doctor_id": doctor_id, "user_id": random.choice(user_ids),
+                          "date": start.strftime("%Y-%m-%d"), "time": start.strftime("%H:%M"), "start": start,
+                          "status": ("requested", "confirmed", "rejected")[n % 3], "active": n % 3 != 2,
+                          "version": n + 1})
+    db["slots_collection"].insert_many(slots)
+    occupancy = {}
+    for slot in slots:
+        if slot["active"]:
+            key = (slot["doctor_id"], datetime.combine(slot["start"].date(), datetime.min.time()))
+            occupancy[key] = occupancy.get(key, 0) | 1 << (slot["start"].hour * 2 + slot["start"].minute // 30)
+    db["occupancy_collection"].insert_many([{"doctor_id": doctor_id, "day": day, "taken": taken}
+                                            for (doctor_id, day), taken in occupancy.items()])
+
+    db["clinics_collection"].insert_many([{"name": f"clinic{i}", "address": "Taganrog", "working_days": {},
+                                           "email": f"clinic{i}@mail.ru", "phone_number": "+7"}
+                                          for i in range(20)])
+    db["prom_history"].insert_many([{"user_id": user_id, "conv_history": []} for user_id in user_ids[:200]])
+
+    for collection, models in INDEXES.items():
+        db[collection].create_indexes(models)
+
+    sample = slots[0]
+    return {
+        "user_id": sample["user_id"],
+        "doctor_id": sample["doctor_id"],
+        "doctor_ids": doctor_ids[:100],
+        "req_id": sample["req_id"],
+        "day": datetime.strptime(sample["date"], "%Y-%m-%d"),
+        "login": "user7@mail.ru",
+        "doctor_login": "doc7",
+        "doctor_email": "doc7@mail.ru",
+        "clinic_name": "clinic3",
+    }
+
+
+def find(collection, query, projection=None, sort=None):
+    return {"collection": collection, "find": query, "projection": projection, "sort": sort}
+
+
+def update(collection, query, change):
+    # update_one / update_many / bulk_write UpdateOne, explained without writing
+    return {"collection": collection, "update": query, "change": change}
+
+
+def aggregate(collection, pipeline):
+    return {"collection": collection, "pipeline": pipeline}
+
+
+def count(collection, query):
+    # count_documents(query, limit=1) is sent as this aggregation
+    return aggregate(collection, [{"$match": query}, {"$limit": 1}, {"$group": {"_id": 1, "n": {"$sum": 1}}}])
+
+
+# name -> (builder, known issue or None). Known issues are reported but do not fail the run.
+SHAPES = {
+    "get_user_with_id": (lambda s: find("users_collection", {"_id": s["user_oid"]},
+                                        q.user_profile_projection), None),
+    "get_user_id": (lambda s: find("users_collection", {"login": s["login"]}, q.user_auth_projection), None),
+    "retrieve_user_credentials": (lambda s: find("users_collection", {"login": s["login"]},
+                                                 q.credentials_projection), None),
+    "get_doc_with_id": (lambda s: find("doctors_collection", {"_id": s["doctor_oid"]},
+                                       q.doctor_auth_projection), None),
+    "get_doc_with_id_for_user": (lambda s: find("doctors_collection", {"_id": s["doctor_oid"]},
+                                                q.doctor_for_user_projection), None),
+    "get_doctor_id": (lambda s: find("doctors_collection", {"login": s["doctor_login"]},
+                                     q.doctor_auth_projection), None),
+    "get_doctor_id_email": (lambda s: find("doctors_collection", {"email": s["doctor_email"]},
+                                           q.doctor_auth_projection), None),
+    "get_events_delta": (lambda s: find("slots_collection", q.calendar_changes(s["doctor_id"], 10),
+                                        {"_id": 0}), None),
+    "get_events_delta (full load)": (lambda s: find("slots_collection", q.calendar_changes(s["doctor_id"]),
+                                                    {"_id": 0}), None),
+    "get_events_delta (version)": (lambda s: find("slots_collection", q.doctor_calendar(s["doctor_id"]),
+                                                  {"_id": 0, "version": 1}, sort=dict(q.NEWEST_VERSION)), None),
+    "get_users_with_ids": (lambda s: find("users_collection", {"_id": {"$in": [s["user_oid"]]}},
+                                          q.user_card_projection), None),
+    "get_docs_by_clinics": (lambda s: find("doctors_collection", {"clinic_name": s["clinic_name"]}), None),
+    "get_clinics": (lambda s: find("clinics_collection", {"name": {"$regex": ".*clinic3.*", "$options": "i"}}),
+                    "substring search over clinic names cannot use an index"),
+    "get_confirms / get_requests": (lambda s: find("slots_collection", q.doctor_slots(s["doctor_id"], q.CONFIRMED),
+                                                   {"_id": 0}, sort={"start": 1}), None),
+    "get_confirms (calendar window)": (lambda s: find("slots_collection",
+                                                      q.doctor_slots(s["doctor_id"], q.CONFIRMED,
+                                                                     datetime(2024, 4, 1), datetime(2024, 4, 8)),
+                                                      {"_id": 0}, sort={"start": 1}), None),
+    "recent_patients": (lambda s: find("slots_collection", q.doctor_slots(s["doctor_id"], q.CONFIRMED),
+                                       {"_id": 0}, sort={"version": 1}), None),
+    "reserve_active_appointment": (lambda s: update("users_collection", q.quota_left(s["user_oid"], 4),
+                                                    {"$inc": {"active_appointments": 1}}), None),
+    "get_confirms_user / get_requests_user": (lambda s: aggregate("slots_collection",
+                                                                  q.user_calendar(s["user_id"], q.CONFIRMED,
+                                                                                  datetime(2024, 4, 1),
+                                                                                  datetime(2024, 5, 1))), None),
+    "taken_check": (lambda s: find("occupancy_collection", q.occupancy_day(s["doctor_id"], s["day"]),
+                                   {"_id": 0, "taken": 1}), None),
+    "occupancy_update": (lambda s: update("occupancy_collection", q.occupancy_day(s["doctor_id"], s["day"]),
+                                          {"$bit": {"taken": {"or": 1}}}), None),
+    "mark_occupancy (free)": (lambda s: count("slots_collection",
+                                              q.active_slots_between(s["doctor_id"], s["day"], 30)), None),
+    "free_slot_masks": (lambda s: find("occupancy_collection",
+                                       q.occupancy_range([s["doctor_id"]], s["day"], s["day"] + timedelta(days=7)),
+                                       {"_id": 0, "doctor_id": 1, "day": 1, "taken": 1}), None),
+    "free_slot_masks (search)": (lambda s: find("occupancy_collection",
+                                                q.occupancy_range(s["doctor_ids"], s["day"],
+                                                                  s["day"] + timedelta(days=7)),
+                                                {"_id": 0, "doctor_id": 1, "day": 1, "taken": 1}), None),
+    "doctor_working_weeks": (lambda s: find("doctors_collection", {"_id": {"$in": [s["doctor_oid"]]}},
+                                            q.doctor_week_projection), None),
+    "doctor_working_weeks (clinic)": (lambda s: find("clinics_collection", {"name": {"$in": [s["clinic_name"]]}},
+                                                     q.clinic_week_projection), None),
+    "search_doctors": (lambda s: find("doctors_collection", {"specialty": "spec3"},
+                                      q.doctor_search_projection), None),
+    "is_req_id_exists": (lambda s: count("slots_collection", q.active_req_id(s["req_id"])), None),
+    "confirm_appointment1 / reject_appointment": (lambda s: update("slots_collection",
+                                                                   q.pending_slot(s["req_id"], s["doctor_id"]),
+                                                                   {"$set": {"status": q.CONFIRMED,
+                                                                             "version": 100}}), None),
+    "bulk_update_appointments (read)": (lambda s: find("slots_collection",
+                                                       q.doctor_slots_by_ids(s["doctor_id"], [s["req_id"]]),
+                                                       {"_id": 0}), None),
+    "bulk_update_appointments (attribution)": (lambda s: find("slots_collection",
+                                                              q.slots_with_version([s["req_id"]], 1),
+                                                              {"_id": 0, "req_id": 1}), None),
+    "change_active_appointments": (lambda s: update("users_collection", {"_id": s["user_oid"]},
+                                                    {"$inc": {"active_appointments": -1}}), None),
+    "send_prompt history": (lambda s: find("prom_history", {"user_id": s["user_id"]}), None),
+}
+
+
+def plan_stages(plan):
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages += plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            stages += plan_stages(value)
+    return stages
+
+
+def execution_stats(explained):
+    # find() puts executionStats at the top level, aggregations nest it under the $cursor stage
+    if "executionStats" in explained:
+        return explained["executionStats"]
+    for stage in explained.get("stages", []):
+        if "$cursor" in stage:
+            return stage["$cursor"]["executionStats"]
+    return {}
+
+
+def winning_plan(explained):
+    if "queryPlanner" in explained:
+        return explained["queryPlanner"]["winningPlan"]
+    for stage in explained.get("stages", []):
+        if "$cursor" in stage:
+            return stage["$cursor"]["queryPlanner"]["winningPlan"]
+    return {}
+
+
+def explain(db, shape):
+    collection = shape["collection"]
+    if "pipeline" in shape:
+        command = {"aggregate": collection, "pipeline": shape["pipeline"], "cursor": {}}
+    elif "update" in shape:
+        command = {"update": collection, "updates": [{"q": shape["update"], "u": shape["change"]}]}
+    else:
+        command = {"find": collection, "filter": shape["find"]}
+        if shape["projection"]:
+            command["projection"] = shape["projection"]
+        if shape["sort"]:
+            command["sort"] = shape["sort"]
+    return db.command("explain", command, verbosity="executionStats")
+
+
+def check(db, sample, ratio):
+    failures = []
+    for name, (build, known) in SHAPES.items():
+        explained = explain(db, build(sample))
+        stages = plan_stages(winning_plan(explained))
+        stats = execution_stats(explained)
+        examined = max(stats.get("totalDocsExamined", 0), stats.get("totalKeysExamined", 0))
+        returned = max(stats.get("nReturned", 0), 1)
+
+        problems = []
+        if "COLLSCAN" in stages:
+            problems.append("COLLSCAN")
+        if "SORT" in stages:
+            problems.append("blocking SORT")
+        if examined > ratio * returned:
+            problems.append(f"examined {examined} for {returned} returned")
+
+        if not problems:
+            console.log(f"[green]ok[/green]    {name}")
+        elif known:
+            console.log(f"[yellow]known[/yellow] {name}: {', '.join(problems)} ({known})")
+        else:
+            console.log(f"[red]FAIL[/red]  {name}: {', '.join(problems)}")
+            failures.append(name)
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--uri", default="mongodb://localhost:27017")
+    parser.add_argument("--db", default="ipa_query_plans")
+    parser.add_argument("--ratio", type=int, default=10,
+                        help="max documents examined per document returned")
+    args = parser.parse_args(argv)
+
+    client = MongoClient(args.uri)
+    client.drop_database(args.db)
+    db = client[args.db]
+    try:
+        sample = seed(db)
+        sample["user_oid"] = db["users_collection"].find_one({"login": sample["login"]})["_id"]
+        sample["doctor_oid"] = db["doctors_collection"].find_one({"login": sample["doctor_login"]})["_id"]
+        failures = check(db, sample, args.ratio)
+    finally:
+        client.drop_database(args.db)
+
+    if failures:
+        console.log(f"{len(failures)} query shape(s) regressed: {', '.join(failures)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())